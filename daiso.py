@@ -1,41 +1,82 @@
-import requests
+import httpx
 import json
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 import asyncio
 import asyncclick as click
 import logging
+import re
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from os import path
-from typing import List, Dict
+from html import unescape
+from os import fsync, path, remove, replace
+from typing import IO, Callable, Dict, Iterator, List, TextIO, Tuple, TypeVar
+import xml.etree.ElementTree as ET  # nosec B405
+
+try:
+    import orjson
+except ImportError:  # orjsonがない環境では標準ライブラリのjsonを使う
+    orjson = None
+
+T = TypeVar("T")
 
 # ロガーの設定
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
-RSS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8" ?>
+RSS_HEADER = """<?xml version="1.0" encoding="UTF-8" ?>
 <rss version="2.0">
     <channel>
         <title>DAISOの新着商品</title>
         <link>https://jp.daisonet.com/collections/newarrival</link>
         <description>DAISO 新着商品の一覧</description>
         <lastBuildDate>{lastBuildDate}</lastBuildDate>
-        <language>ja</language>{items}
+        <language>ja</language>"""
+
+RSS_FOOTER = """
     </channel>
 </rss>
 """
 
+# ループ内で毎回テンプレートを解釈しないよう、%形式(title, link, pubDate)にしている
 ITEM_TEMPLATE = """
         <item>
-            <title>{title}</title>
-            <link>{link}</link>
-            <pubDate>{pubDate}</pubDate>
+            <title>%s</title>
+            <link>%s</link>
+            <pubDate>%s</pubDate>
         </item>"""
 
+# 商品名やURLに含まれるXMLの特殊文字をエスケープするための変換テーブル
+XML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
 URL = "https://jp.daisonet.com/collections/newarrival"
 DATE_FORMAT = "%a, %d %b %Y %H:%M:%S +0900"
 JST = timezone(timedelta(hours=9))
-NOW = datetime.now(JST).strftime(DATE_FORMAT)
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+# DOMパース(フォールバック)で使うCSSセレクター
+PRODUCT_SELECTOR = "div.product-list.product-list--collection.product-list--with-sidebar div.product-item a.product-item__title"
+PAGE_SELECTOR = "div.pagination__nav a[data-page]"
+# DOMを構築せずにHTML文字列から直接抽出するための正規表現
+PRODUCT_ANCHOR_RE = re.compile(
+    r'<a\s+class="(?:[^"]*\s)?product-item__title(?:\s[^"]*)?"\s+href="(?P<href>[^"]+)"[^>]*>\s*(?P<title>[^<]+?)\s*</a>'
+)
+# 正規表現で取りこぼしがないかを確かめるため、商品名のclassを持つ要素を数える
+PRODUCT_TITLE_CLASS_RE = re.compile(r'class="(?:[^"]*\s)?product-item__title(?:\s[^"]*)?"')
+PAGE_NUMBER_RE = re.compile(r'data-page="(\d+)"')
+# 商品リスト・ページネーションのdivの開始タグ (style/script内の同名のclassは拾わない)
+PRODUCT_LIST_OPEN_RE = re.compile(r'<div\b[^>]*\bclass="(?:[^"]*\s)?product-list--collection(?:\s[^"]*)?"')
+PAGINATION_OPEN_RE = re.compile(r'<div\b[^>]*\bclass="(?:[^"]*\s)?pagination__nav(?:\s[^"]*)?"')
+# コンテナの範囲を求めるため、divの開始・終了タグを拾う
+DIV_TAG_RE = re.compile(r"<(/?)div\b", re.IGNORECASE)
+# 正規表現で取りこぼしがあった場合に、DOMをパースして取り直す
+SAFE_PARSE = True
+# ページキャッシュの形式。パーサーやパース結果の形式を変えたら上げて、古い結果を使わないようにする
+PAGE_CACHE_VERSION = 1
+
+# 全ページの取得でTCP/TLS接続を使い回すための接続数の上限
+LIMITS = httpx.Limits(max_keepalive_connections=8, max_connections=8)
 
 
 def get_image_url(data_src: str, width: int) -> str:
@@ -51,121 +92,232 @@ def get_image_url(data_src: str, width: int) -> str:
     return "https:" + data_src.format(width=width)
 
 
-def _get_last_page(soup: BeautifulSoup) -> int:
+def _find_container(html: str, open_tag_re: re.Pattern) -> Tuple[int, int] | None:
+    """
+    open_tag_reに一致するdivの開始タグから、対応する閉じタグまでの範囲を求めます。
+
+    :param html: ページのHTML文字列
+    :param open_tag_re: コンテナのdivの開始タグに一致する正規表現
+    :return: (開始位置, 終了位置)。見つからない場合はNone
+    """
+    open_tag = open_tag_re.search(html)
+    if open_tag is None:
+        return None
+    start = open_tag.start()
+    depth = 0
+    for m in DIV_TAG_RE.finditer(html, start):
+        depth += -1 if m[1] else 1
+        if depth == 0:
+            return start, m.start()
+    # 閉じタグが見つからない場合は末尾までをコンテナとみなす
+    return start, len(html)
+
+
+def _get_last_page(html: str) -> int:
     """
     ページネーションから最終ページ番号を取得します。
 
-    :param soup: BeautifulSoupオブジェクト
+    :param html: ページのHTML文字列
     :return: 最終ページ番号
     """
-    pagination_nav = soup.find("div", class_="pagination__nav")
-    if not pagination_nav:
+    container = _find_container(html, PAGINATION_OPEN_RE)
+    if container is None:
+        # 開始タグの書式が想定と違うだけの場合に備え、classがあればDOMで確認する
+        if SAFE_PARSE and "pagination__nav" in html:
+            return _get_last_page_with_dom(html)
         return 1
-    pages = pagination_nav.find_all("a", {"data-page": True})
-    if not pages:
-        return 1
-    last_page = max(int(page["data-page"]) for page in pages)
-    return last_page
+    pages = PAGE_NUMBER_RE.findall(html, *container)
+    if not pages and SAFE_PARSE:
+        return _get_last_page_with_dom(html)
+    return max(map(int, pages), default=1)
+
+
+def _get_last_page_with_dom(html: str) -> int:
+    """
+    _get_last_pageのフォールバックとして、DOMをパースして最終ページ番号を取得します。
+
+    :param html: ページのHTML文字列
+    :return: 最終ページ番号
+    """
+    tree = LexborHTMLParser(html)
+    return max((int(a.attributes["data-page"]) for a in tree.css(PAGE_SELECTOR)), default=1)
 
 
-def _parse_products_from_page(soup: BeautifulSoup) -> List[Dict[str, str]]:
+def _parse_products_from_page(html: str) -> List[Dict[str, str]]:
     """
     単一ページから商品情報を抽出します。
 
-    :param soup: BeautifulSoupオブジェクト
+    :param html: ページのHTML文字列
     :return: 商品データのリスト
     """
-    product_list = soup.find("div", class_="product-list product-list--collection product-list--with-sidebar")
-    if not product_list:
-        return []
+    container = _find_container(html, PRODUCT_LIST_OPEN_RE)
+    products = []
+    expected = 0
+    if container is not None:
+        products = [
+            {"title": unescape(m["title"]), "link": f"https://jp.daisonet.com{unescape(m['href'])}"}
+            for m in PRODUCT_ANCHOR_RE.finditer(html, *container)
+        ]
+        expected = len(PRODUCT_TITLE_CLASS_RE.findall(html, *container))
+    # 何も取れなかった場合や、属性の順番・商品名内のタグなどで一部でも取りこぼした場合はDOMで取り直す
+    if SAFE_PARSE and (not products or len(products) != expected):
+        logger.warning("Regex scan found no or missing products, falling back to DOM parsing.")
+        return _parse_products_with_dom(html)
+    for product in products:
+        logger.info(f"Found product: {product['title']}")
+    return products
+
 
+def _parse_products_with_dom(html: str) -> List[Dict[str, str]]:
+    """
+    _parse_products_from_pageのフォールバックとして、DOMをパースして商品情報を抽出します。
+
+    :param html: ページのHTML文字列
+    :return: 商品データのリスト
+    """
+    tree = LexborHTMLParser(html)
     products = []
-    for item in product_list.find_all("div", class_="product-item"):
-        try:
-            title_element = item.find("a", class_="product-item__title")
-            if title_element:
-                title = title_element.text.strip()
-                link = f"https://jp.daisonet.com{title_element['href']}"
-                logger.info(f"Found product: {title}")
-                products.append({"title": title, "link": link})
-        except (AttributeError, TypeError):
+    for title_element in tree.css(PRODUCT_SELECTOR):
+        href = title_element.attributes.get("href")
+        if not href:
             logger.warning("Skipping an item due to missing information.")
             continue
+        title = title_element.text(strip=True)
+        link = f"https://jp.daisonet.com{href}"
+        logger.info(f"Found product: {title}")
+        products.append({"title": title, "link": link})
     return products
 
 
-async def fetch_new_arrivals() -> List[Dict[str, str]]:
+def _parse_first_page(html: str) -> Tuple[int, List[Dict[str, str]]]:
+    """
+    1ページ目から最終ページ番号と商品情報をまとめて抽出します。
+
+    :param html: ページのHTML文字列
+    :return: (最終ページ番号, 商品データのリスト)
+    """
+    return _get_last_page(html), _parse_products_from_page(html)
+
+
+def _conditional_headers(entry: Dict | None) -> Dict[str, str]:
+    """
+    ページキャッシュのETag/Last-Modifiedから条件付きリクエストのヘッダーを生成します。
+
+    :param entry: ページキャッシュのエントリ
+    :return: リクエストヘッダー
+    """
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+async def fetch_new_arrivals(cache: Dict[str, Dict] | None = None) -> List[Dict[str, str]]:
     """
     DAISOの新着商品情報を全ページからスクレイピングして、商品データを抽出します。
 
+    :param cache: ページURLごとのETag/Last-Modifiedとパース結果。渡した場合は条件付きリクエストに使い、今回の結果で置き換えます
     :return: 商品データのリスト(辞書型 {"title": 商品名, "link": 商品のURL})
     """
     all_products = []
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
-    loop = asyncio.get_running_loop()
-
-    # First page to get pagination info
-    logger.info("Fetching page 1 to determine total pages...")
-    response = await loop.run_in_executor(None, lambda: requests.get(URL, headers=headers, timeout=60))
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
-
-    last_page = _get_last_page(soup)
-    logger.info(f"Total pages found: {last_page}")
-
-    # Process first page
-    logger.info("Processing page 1...")
-    all_products.extend(_parse_products_from_page(soup))
-
-    # Process remaining pages
-    if last_page > 1:
-        tasks = []
-        sem = asyncio.Semaphore(5)
-
-        async def _fetch_page(page_num: int):
+    old_cache = cache or {}
+    new_cache = {}
+    sem = asyncio.Semaphore(5)
+
+    async with httpx.AsyncClient(headers=HEADERS, timeout=60, limits=LIMITS) as client:
+
+        async def _fetch(url: str, parse: Callable[[str], T]) -> T:
+            entry = old_cache.get(url)
+            # パース結果を持たない壊れたエントリはキャッシュがないものとして扱う
+            if not isinstance(entry, dict) or "result" not in entry:
+                entry = None
             async with sem:
-                logger.info(f"Fetching and processing page {page_num}...")
-                page_url = f"{URL}?page={page_num}"
-                try:
-                    response = await loop.run_in_executor(None, lambda: requests.get(page_url, headers=headers, timeout=60))
-                    response.raise_for_status()
-                    soup = BeautifulSoup(response.text, "html.parser")
-                    return _parse_products_from_page(soup)
-                except requests.RequestException as e:
-                    logger.error(f"Could not fetch page {page_num}: {e}")
-                    return []
-
-        for page_num in range(2, last_page + 1):
-            tasks.append(_fetch_page(page_num))
-
-        results = await asyncio.gather(*tasks)
-        for result in results:
+                logger.info(f"Fetching {url}...")
+                response = await client.get(url, headers=_conditional_headers(entry))
+            # 前回から変更がなければ、パースせずに前回の結果を使う
+            if response.status_code == 304 and entry:
+                logger.info(f"Not modified, using cached result: {url}")
+                new_cache[url] = entry
+                return entry["result"]
+            response.raise_for_status()
+            result = parse(response.text)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                new_cache[url] = {"etag": etag, "last_modified": last_modified, "result": result}
+            return result
+
+        # First page to get pagination info
+        last_page, products = await _fetch(URL, _parse_first_page)
+        logger.info(f"Total pages found: {last_page}")
+        all_products.extend(products)
+
+        # Process remaining pages
+        # 各ページは取得した時点でパースされるため、HTMLを保持し続けることはない
+        page_nums = range(2, last_page + 1)
+        results = await asyncio.gather(
+            *(_fetch(f"{URL}?page={page_num}", _parse_products_from_page) for page_num in page_nums),
+            return_exceptions=True,
+        )
+        for page_num, result in zip(page_nums, results):
+            if isinstance(result, httpx.HTTPError):
+                logger.error(f"Could not fetch page {page_num}: {result}")
+                continue
+            if isinstance(result, BaseException):
+                raise result
             all_products.extend(result)
 
+    # 今回取得しなかったページのエントリは残さない
+    if cache is not None:
+        cache.clear()
+        cache.update(new_cache)
     return all_products
 
 
-def generate_rss(products: list, exist_products: dict) -> str:
+@contextmanager
+def _atomic_open(dest: str, mode: str = "w", **kwargs) -> Iterator[IO]:
     """
-    商品データを元にRSS形式のXMLを生成します。
+    一時ファイルに書き込み、書き込みが完了した場合のみ出力先と置き換えます。
+    途中で失敗しても既存のファイルは壊れません。
+
+    :param dest: 出力先のファイルパス
+    :param mode: openに渡すモード
+    :return: 一時ファイルのファイルオブジェクト
+    """
+    tmp_path = dest + ".tmp"
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp_path, dest)
+    except BaseException:
+        if path.exists(tmp_path):
+            remove(tmp_path)
+        raise
+
+
+def write_rss(products: list, exist_products: dict, now: str, out_file: TextIO) -> None:
+    """
+    商品データを元にRSS形式のXMLを生成し、ファイルへ順に書き出します。
 
     :param products: 商品データのリスト
     :param exist_products: 既存の商品データのリスト
-    :return: RSS形式のXML
+    :param now: 実行時刻 (formatted: Wed, 11 Jun 2008 15:30:59 +0900)
+    :param out_file: 書き込み先のファイルオブジェクト
     """
-    items = ""
-    # formatted: Wed, 11 Jun 2008 15:30:59 +0900
+    write = out_file.write
+    write(RSS_HEADER.format(lastBuildDate=now))
     for product in products:
         # 既存の商品データに含まれている場合はmerge
         title = product["title"]
-        items += ITEM_TEMPLATE.format(
-            title=title,
-            link=product["link"],
-            pubDate=exist_products.get(title, NOW),
+        write(
+            ITEM_TEMPLATE % (title.translate(XML_ESCAPE), product["link"].translate(XML_ESCAPE), exist_products.get(title, now))
         )
-    return RSS_TEMPLATE.format(lastBuildDate=NOW, items=items)
+    write(RSS_FOOTER)
 
 
 def get_exist_titles(xml_path: str) -> dict:
@@ -175,11 +327,34 @@ def get_exist_titles(xml_path: str) -> dict:
     # 既存のファイルがあれば、商品タイトルを取得する
     if not path.exists(xml_path):
         return {}
-    with open(xml_path, "r", encoding="utf-8") as file:
-        # MEMO xmlをhtmlでparseしてwarningがでるが依存ライブラリ増やしたくないので一旦無視
-        soup = BeautifulSoup(file, "html.parser")
-        titles = {item.find("title").text: item.find("pubdate").text for item in soup.find_all("item")}
-        return titles
+    titles = {}
+    with open(xml_path, "rb") as file:
+        # 自分で生成したRSSのみを読むため、標準ライブラリのパーサーで問題ない
+        try:
+            for _, elem in ET.iterparse(file, events=("end",)):  # noqa: S314  # nosec B314
+                if elem.tag == "item":
+                    title = elem.findtext("title")
+                    if title:
+                        titles[title] = elem.findtext("pubDate")
+                    elem.clear()
+        except ET.ParseError as e:
+            # エスケープ処理を入れる前のRSSは&などを含み、XMLとして読めないことがある
+            logger.warning(f"既存のRSSの読み込みに失敗したため、読み込めた {len(titles)} 件のみを使います: {e}")
+    return titles
+
+
+def _json_loads(data: bytes):
+    """JSONを読み込みます。orjsonがあればそちらを使います。"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(data) -> bytes:
+    """JSONをUTF-8のバイト列に変換します。orjsonがあればそちらを使います。"""
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
 
 
 def load_history(history_path: str, xml_path: str) -> Dict[str, str]:
@@ -189,8 +364,8 @@ def load_history(history_path: str, xml_path: str) -> Dict[str, str]:
     """
     if path.exists(history_path):
         try:
-            with open(history_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(history_path, "rb") as f:
+                return _json_loads(f.read())
         except Exception as e:
             logger.warning(f"履歴ファイルの読み込みに失敗しました: {e}")
 
@@ -205,12 +380,38 @@ def load_history(history_path: str, xml_path: str) -> Dict[str, str]:
 def save_history(history_path: str, data: Dict[str, str]) -> None:
     """履歴データをJSONファイルに保存します。"""
     try:
-        with open(history_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        with _atomic_open(history_path, "wb") as f:
+            f.write(_json_dumps(data))
     except Exception as e:
         logger.error(f"履歴ファイルの保存に失敗しました: {e}")
 
 
+def load_page_cache(cache_path: str) -> Dict[str, Dict]:
+    """
+    ページキャッシュ(JSON)を読み込みます。
+    ファイルがない場合や、保存時とキャッシュのバージョンが異なる場合は空のキャッシュを返します。
+    """
+    if path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                data = _json_loads(f.read())
+            if isinstance(data, dict) and data.get("version") == PAGE_CACHE_VERSION and isinstance(data.get("pages"), dict):
+                return data["pages"]
+            logger.info("ページキャッシュのバージョンが異なるため、破棄します。")
+        except Exception as e:
+            logger.warning(f"ページキャッシュの読み込みに失敗しました: {e}")
+    return {}
+
+
+def save_page_cache(cache_path: str, cache: Dict[str, Dict]) -> None:
+    """ページキャッシュをバージョン付きでJSONファイルに保存します。"""
+    try:
+        with _atomic_open(cache_path, "wb") as f:
+            f.write(_json_dumps({"version": PAGE_CACHE_VERSION, "pages": cache}))
+    except Exception as e:
+        logger.error(f"ページキャッシュの保存に失敗しました: {e}")
+
+
 @click.command()
 @click.option(
     "--output",
@@ -222,32 +423,41 @@ async def main(output: str) -> None:
     """
     DAISOの新着商品情報を取得して、RSS形式で出力します。
     """
+    now = datetime.now(JST).strftime(DATE_FORMAT)
     try:
         # 履歴ファイルのパスを出力ファイル名から生成 (例: docs/daiso_new_arrivals.xml -> docs/daiso_new_arrivals_history.json)
         history_path = path.splitext(output)[0] + "_history.json"
+        # 各ページのETag/Last-Modifiedとパース結果 (例: docs/daiso_new_arrivals_cache.json)
+        cache_path = path.splitext(output)[0] + "_cache.json"
 
         logger.info("新着商品情報を取得中...")
-        products = await fetch_new_arrivals()
+        page_cache = load_page_cache(cache_path)
+        products = await fetch_new_arrivals(page_cache)
+        save_page_cache(cache_path, page_cache)
         logger.info(f"{len(products)} 件の商品を取得しました。")
 
         # 過去のデータを読み込む
         exist_titles = load_history(history_path, output)
         logger.info(f"過去のデータから {len(exist_titles)} 件の商品タイトルを読み込みました。")
 
-        # 新しい商品のみを抽出
+        # 新しい商品のみを抽出 (ページ間で重複した商品は1件にまとめる)
+        seen_new = set()
         new_products = []
         for product in products:
-            if product["title"] not in exist_titles:
-                new_products.append(product)
-                exist_titles[product["title"]] = NOW
+            title = product["title"]
+            if title in exist_titles or title in seen_new:
+                continue
+            seen_new.add(title)
+            new_products.append(product)
+        for title in seen_new:
+            exist_titles[title] = now
 
         logger.info(f"{len(new_products)} 件の新しい商品が見つかりました。")
 
         logger.info("RSSファイルを生成中...")
-        rss_content = generate_rss(new_products, exist_titles)
-
-        with open(output, "w", encoding="utf-8") as file:
-            file.write(rss_content)
+        # 全体を文字列に組み立てず、64KiBのバッファ経由で一時ファイルに書き出してから置き換える
+        with _atomic_open(output, "w", encoding="utf-8", buffering=1 << 16, newline="") as file:
+            write_rss(new_products, exist_titles, now, file)
 
         # 履歴を保存
         save_history(history_path, exist_titles)
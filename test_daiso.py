@@ -1,8 +1,9 @@
 # ruff: noqa: S101
 import pytest
+import httpx
+import io
 import json
-from unittest.mock import MagicMock, patch, mock_open
-from bs4 import BeautifulSoup
+from unittest.mock import AsyncMock, patch, mock_open
 import daiso
 
 # テスト用データ
@@ -32,6 +33,11 @@ HTML_PRODUCT_LIST = """
 """
 
 
+def _response(text: str = "", status_code: int = 200, headers: dict | None = None) -> httpx.Response:
+    """HTML文字列からhttpxのレスポンスを生成するヘルパー"""
+    return httpx.Response(status_code, text=text, headers=headers, request=httpx.Request("GET", daiso.URL))
+
+
 def test_get_image_url():
     """画像URL生成のテスト"""
     src = "//example.com/image_{width}.jpg"
@@ -41,20 +47,17 @@ def test_get_image_url():
 
 def test_get_last_page_with_pagination():
     """ページネーションがある場合の最終ページ取得テスト"""
-    soup = BeautifulSoup(HTML_PAGINATION, "html.parser")
-    assert daiso._get_last_page(soup) == 24
+    assert daiso._get_last_page(HTML_PAGINATION) == 24
 
 
 def test_get_last_page_no_pagination():
     """ページネーションがない（1ページのみ）場合のテスト"""
-    soup = BeautifulSoup("<div></div>", "html.parser")
-    assert daiso._get_last_page(soup) == 1
+    assert daiso._get_last_page("<div></div>") == 1
 
 
 def test_parse_products_from_page():
     """商品情報のパーステスト"""
-    soup = BeautifulSoup(HTML_PRODUCT_LIST, "html.parser")
-    products = daiso._parse_products_from_page(soup)
+    products = daiso._parse_products_from_page(HTML_PRODUCT_LIST)
 
     assert len(products) == 2
     assert products[0]["title"] == "商品A"
@@ -62,17 +65,130 @@ def test_parse_products_from_page():
     assert products[1]["title"] == "商品B"
 
 
-def test_generate_rss():
+def test_parse_products_from_page_fallback_dom():
+    """正規表現で取れない属性順でもDOMパースで取得できることのテスト"""
+    html = HTML_PRODUCT_LIST.replace(
+        'class="product-item__title" href="/collections/newarrival/products/item1"',
+        'href="/collections/newarrival/products/item1" class="product-item__title"',
+    ).replace(
+        'class="product-item__title" href="/collections/newarrival/products/item2"',
+        'href="/collections/newarrival/products/item2" class="product-item__title"',
+    )
+    products = daiso._parse_products_from_page(html)
+
+    assert [p["title"] for p in products] == ["商品A", "商品B"]
+    assert products[0]["link"] == "https://jp.daisonet.com/collections/newarrival/products/item1"
+
+
+def test_parse_products_from_page_outside_list():
+    """商品リストの外にある同じclassのリンクを拾わないことのテスト"""
+    recommend = '<div class="recommend"><a class="product-item__title" href="/products/other">おすすめ商品</a></div>'
+    html = HTML_PRODUCT_LIST + recommend
+    products = daiso._parse_products_from_page(html)
+
+    assert [p["title"] for p in products] == ["商品A", "商品B"]
+    assert products == daiso._parse_products_with_dom(html)
+
+
+def test_parse_products_from_page_partial_fallback_dom():
+    """正規表現で一部の商品だけ取れない場合もDOMパースで取り直すテスト"""
+    html = HTML_PRODUCT_LIST.replace(
+        'class="product-item__title" href="/collections/newarrival/products/item2"',
+        'href="/collections/newarrival/products/item2" class="product-item__title"',
+    )
+    products = daiso._parse_products_from_page(html)
+
+    assert [p["title"] for p in products] == ["商品A", "商品B"]
+
+
+def test_parse_products_from_page_marker_in_style():
+    """商品リストのclass名がstyle内に先に現れても商品を取得できることのテスト"""
+    html = (
+        "<html><head><style>.product-list--collection{margin:0}</style></head><body>"
+        '<div class="header"><a class="product-item__title" href="/products/other">ヘッダー</a></div>'
+        + HTML_PRODUCT_LIST
+        + "</body></html>"
+    )
+    products = daiso._parse_products_from_page(html)
+
+    assert [p["title"] for p in products] == ["商品A", "商品B"]
+
+
+def test_parse_products_from_page_no_regex_match():
+    """商品リスト内で正規表現に1件も一致しない場合もDOMパースで取得できることのテスト"""
+    html = HTML_PRODUCT_LIST.replace('class="product-item__title"', "class='product-item__title'")
+    products = daiso._parse_products_from_page(html)
+
+    assert [p["title"] for p in products] == ["商品A", "商品B"]
+
+
+def test_get_last_page_outside_pagination():
+    """ページネーションの外にあるdata-pageを拾わないことのテスト"""
+    html = HTML_PAGINATION.replace('data-page="24"', 'data-page="2"') + '<div data-page="99"></div>'
+    assert daiso._get_last_page(html) == 3
+    assert daiso._get_last_page_with_dom(html) == 3
+
+
+def test_get_last_page_marker_in_style():
+    """ページネーションのclass名がstyle内に先に現れても、別のdivのdata-pageを拾わないことのテスト"""
+    html = (
+        "<style>.pagination__nav{display:flex}</style>"
+        '<div class="slider"><span data-page="99"></span></div>' + HTML_PAGINATION.replace('data-page="24"', 'data-page="2"')
+    )
+    assert daiso._get_last_page(html) == 3
+
+
+def test_parse_first_page():
+    """1ページ目から最終ページ番号と商品情報を同時に取得するテスト"""
+    last_page, products = daiso._parse_first_page(HTML_PAGINATION + HTML_PRODUCT_LIST)
+
+    assert last_page == 24
+    assert [p["title"] for p in products] == ["商品A", "商品B"]
+
+
+def test_write_rss():
     """RSS生成のテスト"""
     products = [{"title": "New Item", "link": "http://example.com/new"}]
     exist_products = {"New Item": "Wed, 01 Jan 2025 00:00:00 +0900"}
 
-    rss = daiso.generate_rss(products, exist_products)
+    out = io.StringIO()
+    daiso.write_rss(products, exist_products, "Thu, 02 Jan 2025 00:00:00 +0900", out)
+    rss = out.getvalue()
 
     assert "<title>New Item</title>" in rss
     assert "<link>http://example.com/new</link>" in rss
     # 既存の日付が使われているか確認
     assert "<pubDate>Wed, 01 Jan 2025 00:00:00 +0900</pubDate>" in rss
+    assert "<lastBuildDate>Thu, 02 Jan 2025 00:00:00 +0900</lastBuildDate>" in rss
+
+
+def test_write_rss_escape():
+    """商品名やURLに含まれるXMLの特殊文字がエスケープされることのテスト"""
+    products = [{"title": "A&B <新商品>", "link": "https://example.com/p?a=1&b=2"}]
+
+    out = io.StringIO()
+    daiso.write_rss(products, {}, "Thu, 02 Jan 2025 00:00:00 +0900", out)
+    rss = out.getvalue()
+
+    assert "<title>A&amp;B &lt;新商品&gt;</title>" in rss
+    assert "<link>https://example.com/p?a=1&amp;b=2</link>" in rss
+
+
+def test_atomic_open(tmp_path):
+    """書き込み途中で失敗しても既存のファイルが壊れないことのテスト"""
+    dest = tmp_path / "feed.xml"
+    dest.write_text("old", encoding="utf-8")
+
+    with pytest.raises(RuntimeError):
+        with daiso._atomic_open(str(dest), encoding="utf-8") as f:
+            f.write("broken")
+            raise RuntimeError
+    assert dest.read_text(encoding="utf-8") == "old"
+    assert not (tmp_path / "feed.xml.tmp").exists()
+
+    with daiso._atomic_open(str(dest), encoding="utf-8") as f:
+        f.write("new")
+    assert dest.read_text(encoding="utf-8") == "new"
 
 
 def test_get_exist_titles():
@@ -94,6 +210,18 @@ def test_get_exist_titles():
             assert titles["Existing Item"] == "Tue, 31 Dec 2024 00:00:00 +0900"
 
 
+def test_get_exist_titles_legacy_unescaped():
+    """エスケープされていない&を含む古いRSSでも処理を止めないことのテスト"""
+    xml_content = """<rss><channel>
+        <item><title>Item A</title><pubDate>Date A</pubDate></item>
+        <item><title>A&B</title><link>https://example.com/p?a=1&b=2</link><pubDate>Date B</pubDate></item>
+    </channel></rss>"""
+    with patch("daiso.path.exists", side_effect=lambda p: p.endswith(".xml")):
+        with patch("builtins.open", mock_open(read_data=xml_content)):
+            result = daiso.load_history("history.json", "dummy.xml")
+            assert result == {"Item A": "Date A"}
+
+
 def test_load_history_json():
     """JSON履歴読み込みのテスト"""
     history_data = {"Item A": "Date A"}
@@ -103,6 +231,19 @@ def test_load_history_json():
             assert result == history_data
 
 
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_save_and_load_history(tmp_path, use_orjson):
+    """履歴の保存と読み込みのテスト(orjsonがない場合は標準のjsonを使う)"""
+    history_path = str(tmp_path / "history.json")
+    history_data = {"商品A": "Wed, 01 Jan 2025 00:00:00 +0900"}
+
+    with patch("daiso.orjson", daiso.orjson if use_orjson else None):
+        daiso.save_history(history_path, history_data)
+        assert daiso.load_history(history_path, "dummy.xml") == history_data
+    # 日本語をエスケープせずに保存すること
+    assert "商品A" in (tmp_path / "history.json").read_text(encoding="utf-8")
+
+
 def test_load_history_fallback_xml():
     """JSONがなくXMLがある場合のフォールバックテスト"""
     xml_content = """<rss><channel><item><title>Item B</title><pubDate>Date B</pubDate></item></channel></rss>"""
@@ -119,20 +260,16 @@ async def test_fetch_new_arrivals():
     """非同期スクレイピングのテスト"""
 
     # 1ページ目のレスポンス（全2ページと仮定）
-    mock_resp_p1 = MagicMock()
-    mock_resp_p1.status_code = 200
-    # data-page="24" を "2" に書き換えてテスト時間を短縮
-    pagination_short = HTML_PAGINATION.replace('data-page="24"', 'data-page="2"')
-    mock_resp_p1.text = pagination_short + HTML_PRODUCT_LIST
+    # data-page="3", "24" を "2" に書き換えてテスト時間を短縮
+    pagination_short = HTML_PAGINATION.replace('data-page="3"', 'data-page="2"').replace('data-page="24"', 'data-page="2"')
+    mock_resp_p1 = _response(pagination_short + HTML_PRODUCT_LIST)
 
     # 2ページ目のレスポンス
-    mock_resp_p2 = MagicMock()
-    mock_resp_p2.status_code = 200
     # 商品名を変更して区別
-    mock_resp_p2.text = HTML_PRODUCT_LIST.replace("商品A", "商品C").replace("商品B", "商品D")
+    mock_resp_p2 = _response(HTML_PRODUCT_LIST.replace("商品A", "商品C").replace("商品B", "商品D"), headers={"ETag": '"p2"'})
 
-    # requests.get をモック化
-    with patch("daiso.requests.get") as mock_get:
+    # httpx.AsyncClient.get をモック化
+    with patch("daiso.httpx.AsyncClient.get", new_callable=AsyncMock) as mock_get:
 
         def side_effect(*args, **kwargs):
             url = args[0]
@@ -146,15 +283,87 @@ async def test_fetch_new_arrivals():
         mock_get.side_effect = side_effect
 
         # 実行
-        products = await daiso.fetch_new_arrivals()
+        cache = {}
+        products = await daiso.fetch_new_arrivals(cache)
 
         # 検証
         # 1ページ目(2件) + 2ページ目(2件) = 合計4件
         assert len(products) == 4
 
         titles = [p["title"] for p in products]
-        assert "商品A" in titles
-        assert "商品C" in titles
+        # ページ番号順に並んでいること
+        assert titles == ["商品A", "商品B", "商品C", "商品D"]
 
         # 呼び出し回数の確認 (1ページ目 + 2ページ目)
         assert mock_get.call_count == 2
+
+        # ETagを返したページだけキャッシュされること
+        assert cache == {f"{daiso.URL}?page=2": {"etag": '"p2"', "last_modified": None, "result": products[2:]}}
+
+
+@pytest.mark.asyncio
+async def test_fetch_new_arrivals_not_modified():
+    """304 Not Modified の場合にキャッシュ済みの結果を使うテスト"""
+    cached_products = [{"title": "商品A", "link": "https://jp.daisonet.com/collections/newarrival/products/item1"}]
+    cache = {
+        daiso.URL: {"etag": '"abc"', "last_modified": None, "result": [1, cached_products]},
+        f"{daiso.URL}?page=2": {"etag": '"old"', "last_modified": None, "result": []},
+    }
+
+    with patch("daiso.httpx.AsyncClient.get", new_callable=AsyncMock, return_value=_response(status_code=304)) as mock_get:
+        products = await daiso.fetch_new_arrivals(cache)
+
+        assert products == cached_products
+        # 条件付きリクエストになっていること
+        assert mock_get.call_args.kwargs["headers"] == {"If-None-Match": '"abc"'}
+        # 今回取得しなかったページはキャッシュから消えること
+        assert list(cache) == [daiso.URL]
+
+
+@pytest.mark.asyncio
+async def test_fetch_new_arrivals_page_error():
+    """一部のページの取得に失敗しても、取得できたページの商品を返すテスト"""
+    mock_resp_p1 = _response(HTML_PAGINATION + HTML_PRODUCT_LIST)
+
+    async def side_effect(*args, **kwargs):
+        url = args[0]
+        if "page=" not in url:
+            return mock_resp_p1
+        raise httpx.ConnectError("connection failed")
+
+    with patch("daiso.httpx.AsyncClient.get", new_callable=AsyncMock, side_effect=side_effect) as mock_get:
+        products = await daiso.fetch_new_arrivals()
+
+        assert [p["title"] for p in products] == ["商品A", "商品B"]
+        # 1ページ目 + 2〜24ページ目
+        assert mock_get.call_count == 24
+
+
+def test_save_and_load_page_cache(tmp_path):
+    """ページキャッシュの保存と読み込み、バージョン違いの破棄のテスト"""
+    cache_path = str(tmp_path / "cache.json")
+    cache = {daiso.URL: {"etag": '"abc"', "last_modified": None, "result": [1, []]}}
+
+    daiso.save_page_cache(cache_path, cache)
+    assert daiso.load_page_cache(cache_path) == cache
+
+    # バージョンのない古い形式やバージョン違いは破棄する
+    (tmp_path / "cache.json").write_text(json.dumps(cache), encoding="utf-8")
+    assert daiso.load_page_cache(cache_path) == {}
+    (tmp_path / "cache.json").write_text(json.dumps({"version": 0, "pages": cache}), encoding="utf-8")
+    assert daiso.load_page_cache(cache_path) == {}
+    (tmp_path / "cache.json").write_text("[]", encoding="utf-8")
+    assert daiso.load_page_cache(cache_path) == {}
+
+
+@pytest.mark.asyncio
+async def test_fetch_new_arrivals_broken_cache_entry():
+    """パース結果のないキャッシュエントリは使わずに取得し直すテスト"""
+    cache = {daiso.URL: {"etag": '"abc"', "last_modified": None}}
+
+    with patch("daiso.httpx.AsyncClient.get", new_callable=AsyncMock, return_value=_response(HTML_PRODUCT_LIST)) as mock_get:
+        products = await daiso.fetch_new_arrivals(cache)
+
+        assert [p["title"] for p in products] == ["商品A", "商品B"]
+        # 条件付きリクエストにしないこと
+        assert mock_get.call_args.kwargs["headers"] == {}